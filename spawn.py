@@ -1,6 +1,35 @@
+"""Thin wrapper around subprocess for running commands and pipelines.
+
+Children are started through posix_spawn where possible, see USE_POSIX_SPAWN.
+On interpreters whose Popen can not combine posix_spawn with close_fds
+(CPython before 3.13), enabling it makes close_fds default to False for calls
+that can use posix_spawn (no cwd, pass_fds, preexec_fn, start_new_session,
+process_group, user, group or umask): file descriptors explicitly marked
+inheritable are then passed to those children.
+Pass close_fds=True, or set USE_POSIX_SPAWN = False, to get the plain Popen
+behaviour back.
+"""
+import io
+import os
 import sys
+import time
+import codecs
+import signal
+import struct
 import threading
+import queue
+import shlex
+import shutil
+import functools
+import select
+import selectors
 import subprocess
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 IGNORE = -1
 CAPTURE = -2
@@ -11,6 +40,81 @@ STDOUT = -6
 STDERR = -7
 _UNDEFINED = -8
 
+_VALID_STDIN = frozenset({_UNDEFINED, STDIN, INTERACT, IGNORE})
+_VALID_STDOUT = frozenset({_UNDEFINED, PIPE, CAPTURE, INTERACT, IGNORE, STDOUT, STDERR})
+_OUT_HANDLES = {
+    IGNORE: subprocess.DEVNULL,
+    CAPTURE: subprocess.PIPE,
+    INTERACT: subprocess.PIPE,
+    PIPE: subprocess.PIPE,
+    STDOUT: 'stdout',
+    STDERR: 'stderr',
+}
+
+# Let CPython spawn children with posix_spawn instead of fork+exec.
+# Popen only takes that path when the executable is a path, close_fds is off
+# (unless closefrom is available, CPython 3.13+) and every redirected stdio fd
+# is above 2, so inherited std streams are passed as None and IGNORE uses a
+# cached /dev/null fd. Still falls back to fork+exec: STDOUT/STDERR redirected
+# to the other std stream (stdout=STDERR, stderr=STDOUT), sys.std* replaced by
+# objects backed by fds 0-2 in other slots, and any of cwd, preexec_fn,
+# pass_fds, close_fds=True (before 3.13), start_new_session, process_group,
+# user/group/umask passed in kwargs. close_fds keeps Popen's default when one
+# of those is given, since posix_spawn can not be used anyway.
+USE_POSIX_SPAWN = True
+_POSIX_SPAWN_CLOSES_FDS = getattr(subprocess, '_HAVE_POSIX_SPAWN_CLOSEFROM', False)
+_devnull_fd = None
+
+_READ_CHUNK = 1 << 20
+_PIPE_SIZE = 1 << 20
+_ITER_CHUNK = 1 << 16
+_SEND_BATCH = 1 << 16
+_FRAME_HEADER = struct.Struct('<I')
+_IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in getattr(os, 'sysconf_names', ()) else 1024
+# POSIX guarantees at least 512
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+class _AuxPool(object):
+    # thread pool with daemon workers: ThreadPoolExecutor joins its workers at
+    # interpreter exit, which would block on children that are still running
+    def __init__(self, max_workers, thread_name_prefix):
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._workers = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        if not self._idle.acquire(blocking=False):
+            with self._lock:
+                if self._workers < self._max_workers:
+                    self._workers += 1
+                    thread = threading.Thread(target=self._work,
+                                              name='%s_%d' % (self._thread_name_prefix, self._workers))
+                    thread.daemon = True
+                    thread.start()
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            del future, fn, args, kwargs
+            self._idle.release()
+
+# aux tasks block on child pipes, so the pool must be wide enough
+# to never queue a writer behind readers of the same process
+_AUX_POOL = _AuxPool(max_workers=256, thread_name_prefix='spawn_aux')
+
 class CompletedProcess(subprocess.CompletedProcess):
     pass
 
@@ -20,25 +124,374 @@ class CalledProcessError(subprocess.CalledProcessError):
 class CalledProcessSignal(CalledProcessError):
     pass
 
+class ProtocolError(Exception):
+    pass
+
+@functools.lru_cache(maxsize=1024)
 def _spec_count(template):
-    return template.count('%') - 2 * template.count('%%')
+    count = 0
+    escaped = False
+    for c in template:
+        if c == '%':
+            if escaped:
+                count -= 1
+                escaped = False
+            else:
+                count += 1
+                escaped = True
+        else:
+            escaped = False
+    return count
+
+@functools.lru_cache(maxsize=1024)
+def _split_template(template):
+    # shlex is much slower, only use it when there is quoting to honour;
+    # unbalanced quotes such as "echo it's" keep the plain whitespace split
+    if '"' in template or "'" in template:
+        try:
+            return tuple(shlex.split(template))
+        except ValueError:
+            pass
+    return tuple(template.split())
 
 def cmdline(template, *args):
-    parts = template.split()
-    if not args:
+    parts = list(_split_template(template))
+    if not args or '%' not in template:
         return parts
+    i_arg = 0
     for i, part in enumerate(parts):
+        if '%' not in part:
+            continue
         spec_count = _spec_count(part)
-        part_args = args[:spec_count]
-        parts[i] = part % part_args
-        args = args[spec_count:]
+        parts[i] = part % args[i_arg:i_arg + spec_count]
+        i_arg += spec_count
+    return parts
+
+def _devnull():
+    global _devnull_fd
+    if _devnull_fd is None:
+        _devnull_fd = os.open(os.devnull, os.O_RDWR)
+    return _devnull_fd
+
+def _spawn_handle(handle, std_fd):
+    if handle == subprocess.DEVNULL:
+        return _devnull()
+    if hasattr(handle, 'fileno') and handle.fileno() == std_fd:
+        return None
+    return handle
+
+def _blocks_posix_spawn(kwargs):
+    # Popen arguments that force fork+exec regardless of close_fds
+    if kwargs.get('pass_fds') or kwargs.get('start_new_session'):
+        return True
+    if kwargs.get('umask', -1) >= 0:
+        return True
+    return any(kwargs.get(name) is not None
+               for name in ('cwd', 'preexec_fn', 'process_group', 'user', 'group', 'extra_groups'))
+
+def _spawn_kwargs(cmdline, kwargs):
+    kwargs = dict(kwargs)
+    if not _POSIX_SPAWN_CLOSES_FDS and not _blocks_posix_spawn(kwargs):
+        kwargs.setdefault('close_fds', False)
+    if not kwargs.get('shell') and 'executable' not in kwargs and not os.path.dirname(cmdline[0]):
+        path = os.pathsep.join(os.get_exec_path(kwargs.get('env')))
+        executable = shutil.which(cmdline[0], path=path)
+        if executable:
+            kwargs['executable'] = executable
+    return kwargs
+
+def _spawn_actions(handles, kwargs):
+    # posix_spawn file actions when no pipes are involved, None if not applicable
+    if not hasattr(os, 'posix_spawn') or set(kwargs) - {'env', 'executable', 'close_fds'}:
+        return None
+    # posix_spawn can not close inherited fds
+    if kwargs.get('close_fds') is not False:
+        return None
+    file_actions = []
+    for target, handle in enumerate(handles):
+        if handle is None:
+            continue
+        if handle == subprocess.PIPE:
+            return None
+        fd = handle if isinstance(handle, int) else handle.fileno()
+        if fd <= 2:
+            return None
+        file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    return file_actions
+
+def _direct_spawn(cmdline, file_actions, kwargs):
+    _cleanup()
+    env = kwargs.get('env')
+    if env is None:
+        env = os.environ
+    setsigdef = [getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ')
+                 if hasattr(signal, name)]
+    if 'executable' in kwargs:
+        pid = os.posix_spawn(kwargs['executable'], cmdline, env,
+                             file_actions=file_actions, setsigdef=setsigdef)
+    else:
+        pid = os.posix_spawnp(cmdline[0], cmdline, env,
+                              file_actions=file_actions, setsigdef=setsigdef)
+    return _SpawnedProcess(cmdline, pid)
+
+# children dropped before exiting, reaped on later spawns like subprocess._active
+_active = []
+
+def _cleanup():
+    for inst in _active[:]:
+        if inst.poll() is not None:
+            try:
+                _active.remove(inst)
+            except ValueError:
+                pass
+
+class _SpawnedProcess(object):
+    # minimal Popen stand-in for children started by _direct_spawn
+    stdin = None
+    stdout = None
+    stderr = None
+
+    def __init__(self, args, pid):
+        self.args = args
+        self.pid = pid
+        self.returncode = None
+        # one waitpid at a time, a losing concurrent waitpid would see ECHILD
+        self._waitpid_lock = threading.Lock()
+
+    def __del__(self, _active=_active):
+        if self.returncode is None and self.poll() is None:
+            _active.append(self)
+
+    def _reap(self, flags):
+        # caller holds _waitpid_lock
+        if self.returncode is not None:
+            return
+        try:
+            pid, status = os.waitpid(self.pid, flags)
+        except ChildProcessError:
+            # reaped elsewhere, the status is lost
+            if self.returncode is None:
+                self.returncode = 0
+            return
+        if pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+    def poll(self):
+        # like Popen, a poll racing a blocking wait reports the child as running
+        if self.returncode is None and self._waitpid_lock.acquire(False):
+            try:
+                self._reap(os.WNOHANG)
+            finally:
+                self._waitpid_lock.release()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            with self._waitpid_lock:
+                self._reap(0)
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+def _grow_pipe(fd):
+    # fewer writer/reader wakeups on large outputs, best effort
+    if fcntl is None:
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, _PIPE_SIZE)
+    except (AttributeError, OSError):
+        pass
+
+def _read_all(stream):
+    if isinstance(stream, io.TextIOBase):
+        return stream.read()
+    fd = stream.fileno()
+    chunks = []
+    while True:
+        chunk = os.read(fd, _READ_CHUNK)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def _read_all_multi(*streams):
+    # drains several binary streams from one thread
+    fds = [stream.fileno() for stream in streams]
+    if hasattr(select, 'epoll'):
+        return _read_all_epoll(fds)
+    with selectors.DefaultSelector() as sel:
+        keys = [sel.register(fd, selectors.EVENT_READ, []) for fd in fds]
+        while sel.get_map():
+            for key, _ in sel.select():
+                chunk = os.read(key.fd, _READ_CHUNK)
+                if chunk:
+                    key.data.append(chunk)
+                else:
+                    sel.unregister(key.fd)
+    return [b''.join(key.data) for key in keys]
+
+def _read_all_epoll(fds):
+    # edge-triggered, every wakeup drains the fd until it would block
+    chunks = {fd: [] for fd in fds}
+    pending = set(fds)
+    with select.epoll() as ep:
+        for fd in fds:
+            os.set_blocking(fd, False)
+            ep.register(fd, select.EPOLLIN | select.EPOLLET)
+        while pending:
+            for fd, _ in ep.poll():
+                while True:
+                    try:
+                        chunk = os.read(fd, _READ_CHUNK)
+                    except BlockingIOError:
+                        break
+                    if not chunk:
+                        ep.unregister(fd)
+                        pending.discard(fd)
+                        break
+                    chunks[fd].append(chunk)
+    return [b''.join(chunks[fd]) for fd in fds]
+
+def _capture_into(targets):
+    # targets are (process, attribute, stream) triples
+    if len(targets) == 1:
+        process, name, stream = targets[0]
+        setattr(process, name, _read_all(stream))
+        return
+    captured = _read_all_multi(*(stream for _, _, stream in targets))
+    for (process, name, _), data in zip(targets, captured):
+        setattr(process, name, data)
+
+def _read_lines(fd, chunk, decode, sep):
+    # pieces of the unfinished line are joined once, when it is complete
+    empty = sep[:0]
+    partial = []
+    while True:
+        data = os.read(fd, chunk)
+        eof = not data
+        if decode is not None:
+            data = decode(data, eof)
+        lines = data.split(sep)
+        if len(lines) > 1:
+            partial.append(lines[0])
+            yield empty.join(partial) + sep
+            for line in lines[1:-1]:
+                yield line + sep
+            partial = [lines[-1]]
+        else:
+            partial.append(data)
+        if eof:
+            break
+    tail = empty.join(partial)
+    if tail:
+        yield tail
+
+def _writev_all(fd, buffers):
+    buffers = [memoryview(buf).cast('B') for buf in buffers]
+    while buffers:
+        written = os.writev(fd, buffers[:_IOV_MAX])
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if written:
+            buffers[0] = buffers[0][written:]
+
+def _write_all(fd, data):
+    view = memoryview(data).cast('B')
+    while view:
+        view = view[os.write(fd, view):]
+
+def _write_input(stream, input):
+    # input may be a list/tuple of buffers, written with a single writev
+    try:
+        with stream:
+            if isinstance(stream, io.TextIOBase):
+                if isinstance(input, (list, tuple)):
+                    input = ''.join(input)
+                stream.write(input)
+            elif isinstance(input, (list, tuple)):
+                _writev_all(stream.fileno(), input)
+            else:
+                _write_all(stream.fileno(), input)
+    except BrokenPipeError:
+        # child exited without reading its input, same as Popen.communicate
+        pass
+
+def _fits_pipe_buf(stream, input):
+    # writes up to PIPE_BUF into a fresh pipe never block
+    if isinstance(stream, io.TextIOBase):
+        return False
+    if isinstance(input, (list, tuple)):
+        return sum(len(buf) for buf in input) <= _PIPE_BUF
+    return len(input) <= _PIPE_BUF
+
+def _read_exact(fd, size):
+    chunks = []
+    while size:
+        chunk = os.read(fd, min(size, _READ_CHUNK))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _wait_exit_event(pid, timeout):
+    # returns False on timeout, raises OSError/AttributeError if unsupported
+    if hasattr(os, 'pidfd_open'):
+        fd = os.pidfd_open(pid)
+        try:
+            with selectors.DefaultSelector() as sel:
+                sel.register(fd, selectors.EVENT_READ)
+                return bool(sel.select(timeout))
+        finally:
+            os.close(fd)
+    kq = select.kqueue()
+    try:
+        event = select.kevent(pid, filter=select.KQ_FILTER_PROC,
+                              flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                              fflags=select.KQ_NOTE_EXIT)
+        return bool(kq.control([event], 1, timeout))
+    finally:
+        kq.close()
+
+def _wait_popen(popen, timeout):
+    # Popen.wait polls with sleeps when given a timeout, wait on an exit event instead
+    if timeout is None or popen.returncode is not None:
+        return popen.wait(timeout)
+    try:
+        exited = _wait_exit_event(popen.pid, timeout)
+    except (OSError, AttributeError):
+        return popen.wait(timeout)
+    if not exited:
+        raise subprocess.TimeoutExpired(popen.args, timeout)
+    return popen.wait()
 
 class Runnable(object):
-    def __init__(self):
+    def __init__(self, max_interactive=1):
         self._pipe = None
         self._input = None
         self._output = None
-        assert self._interactive_count() <= 1, 'more than one interactive stream, this causes deadlocks'
+        self._pending = []
+        self._pending_size = 0
+        self.auto_flush = True
+        if self._interactive_count() > max_interactive:
+            raise ValueError('more than one interactive stream, this causes deadlocks')
     
     # builder
     def pipe(self, cmd, *args, **kwargs):
@@ -47,14 +500,32 @@ class Runnable(object):
 
     # blocking execution
     def run(self, input=None, timeout=None):
-        self.start()
+        self.start(input)
         return self.wait(timeout)
 
     def iterate(self, input=None, timeout=None):
         assert timeout is None, 'not implemented'
-        self.start()
+        self.start(input)
         assert self.output
-        for line in self.output:
+        if isinstance(self.output, io.TextIOBase):
+            decoder = codecs.getincrementaldecoder(self.output.encoding)(self.output.errors)
+            decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+            lines = self._iterate_lines(_ITER_CHUNK, decoder.decode, '\n')
+        else:
+            lines = self._iterate_lines(_ITER_CHUNK, None, b'\n')
+        for line in lines:
+            yield line
+
+    def iterate_bytes(self, input=None, chunk=_ITER_CHUNK):
+        self.start(input)
+        assert self.output
+        for line in self._iterate_lines(chunk, None, b'\n'):
+            yield line
+
+    def _iterate_lines(self, chunk, decode, sep):
+        fd = self.output.fileno()
+        _grow_pipe(fd)
+        for line in _read_lines(fd, chunk, decode, sep):
             yield line
         res = self.wait()
         res.check_returncode()
@@ -75,8 +546,37 @@ class Runnable(object):
         return self._input
 
     def send(self, data):
-        self._input.write(data)
+        if self.auto_flush or isinstance(self._input, io.TextIOBase):
+            self._input.write(data)
+            self._input.flush()
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= _SEND_BATCH or len(self._pending) >= _IOV_MAX:
+            self.flush()
+
+    def flush(self):
         self._input.flush()
+        if self._pending:
+            _writev_all(self._input.fileno(), self._pending)
+            self._pending = []
+            self._pending_size = 0
+
+    def close_input(self):
+        # with auto_flush off, close through here so queued data is sent first
+        self.flush()
+        self._input.close()
+
+    def _flush_pending(self):
+        if self._pending:
+            try:
+                self.flush()
+            except BrokenPipeError:
+                # child exited without reading its input, same as Popen.communicate
+                self._pending = []
+                self._pending_size = 0
 
     @property
     def output(self):
@@ -93,30 +593,39 @@ class Runnable(object):
 class Process(Runnable):
     def __init__(self, cmd, *args,
                  stdin=_UNDEFINED, stdout=_UNDEFINED, stderr=_UNDEFINED,
+                 _duplex=False,
                  **kwargs):
         self._cmd = cmd
         self._args = args
         self._cmdline = cmdline(cmd, *args)
 
-        assert stdin in (_UNDEFINED, STDIN, INTERACT) or hasattr(stdin, 'fileno')
+        for name, value, valid in (('stdin', stdin, _VALID_STDIN),
+                                   ('stdout', stdout, _VALID_STDOUT),
+                                   ('stderr', stderr, _VALID_STDOUT)):
+            if value not in valid and not hasattr(value, 'fileno'):
+                raise ValueError('invalid %s: %r' % (name, value))
+        if stdout == PIPE and stderr == PIPE:
+            raise ValueError('stdout and stderr can not both be piped')
         self._stdin = stdin
-        assert stdout not in (STDIN, None)
         self._stdout = stdout
-        assert stderr not in (STDIN, None)
         self._stderr = stderr
-        assert not (stdout == PIPE and stderr == PIPE)
+        self._pstdout = Process._static_handle(stdout)
+        self._pstderr = Process._static_handle(stderr)
         self._kwargs = kwargs
+        self._interactive = int(stdin == INTERACT) + int(stdout == INTERACT) + int(stderr == INTERACT)
         
         self._popen = None
-        self._threads = []
+        self._futures = []
         self._captured_stdout = None
         self._captured_stderr = None
         
+        self._capture_deferred = False
         self._init_pipe = False
-        Runnable.__init__(self)
+        # duplex users alternate between writing and reading, so input and output can both be interactive
+        Runnable.__init__(self, max_interactive=2 if _duplex else 1)
 
     def send_signal(self, signal):
-        self._popen.send_signal(self, signal)
+        self._popen.send_signal(signal)
 
     def terminate(self):
         self._popen.terminate()
@@ -125,62 +634,80 @@ class Process(Runnable):
         self._popen.kill()
 
     def _interactive_count(self):
-        return sum(1 for arg in ('stdout', 'stderr', 'stdin') if self._kwargs.get(arg) == INTERACT)
+        return self._interactive
 
     def _prepare_pipe(self):
         self._init_pipe = True
         if self._stdout != PIPE and self._stderr != PIPE:
-            assert self._stdout == _UNDEFINED
+            if self._stdout != _UNDEFINED:
+                raise ValueError('stdout is already redirected, can not pipe it')
             self._stdout = PIPE
+            self._pstdout = None
 
     def _parallel(self, fn, *args, **kwargs):
-        thread = threading.Thread(target=fn, name='spawn_aux', args=args, kwargs=kwargs)
-        thread.daemon = True
-        thread.start()
-        self._threads.append(thread)
+        self._futures.append(_AUX_POOL.submit(fn, *args, **kwargs))
+
+    @staticmethod
+    def _static_handle(value):
+        # Popen handle if it is known at construction time, None if it depends on start()
+        if value in (_UNDEFINED, PIPE, STDOUT, STDERR):
+            return None
+        return _OUT_HANDLES.get(value, value)
 
     @staticmethod
     def _out_handle(value, default, is_pipe):
-        if value == IGNORE:
-            return subprocess.DEVNULL
-        elif value in (CAPTURE, INTERACT):
-            return subprocess.PIPE
-        elif value == PIPE:
-            assert is_pipe
-            return subprocess.PIPE
-        elif value == _UNDEFINED:
+        if value == _UNDEFINED:
             return default
-        elif value == STDOUT:
-            return sys.stdout
-        elif value == STDERR:
-            return sys.stderr
-        else:
-            assert hasattr(value, 'fileno'), value
-            return value
-
-    def start(self, input=None):
-        assert not self._popen, 'already inited'
-
+        if value == PIPE and not is_pipe:
+            raise ValueError('PIPE is only valid for a piped process')
+        handle = _OUT_HANDLES.get(value, value)
+        if isinstance(handle, str):
+            return getattr(sys, handle)
+        return handle
+
+    def _handles(self, input):
         if input is not None or self._stdin == INTERACT:
-            assert self._stdin in (_UNDEFINED, INTERACT)
+            if self._stdin not in (_UNDEFINED, INTERACT):
+                raise ValueError('input is given but stdin is redirected')
             pstdin = subprocess.PIPE
         elif self._stdin == IGNORE:
             pstdin = subprocess.DEVNULL
         elif self._stdin in (STDIN, _UNDEFINED):
             pstdin = sys.stdin
         else:
-            assert hasattr(self._stdin, 'fileno'), self._stdin
             pstdin = self._stdin
 
-        pstdout = Process._out_handle(self._stdout, sys.stdout, self._init_pipe)
-        pstderr = Process._out_handle(self._stderr, sys.stderr, self._init_pipe)
+        pstdout = self._pstdout
+        if pstdout is None:
+            pstdout = Process._out_handle(self._stdout, sys.stdout, self._init_pipe)
+        pstderr = self._pstderr
+        if pstderr is None:
+            pstderr = Process._out_handle(self._stderr, sys.stderr, self._init_pipe)
+
+        kwargs = self._kwargs
+        if USE_POSIX_SPAWN:
+            pstdin = _spawn_handle(pstdin, 0)
+            pstdout = _spawn_handle(pstdout, 1)
+            pstderr = _spawn_handle(pstderr, 2)
+            kwargs = _spawn_kwargs(self._cmdline, kwargs)
+        return [pstdin, pstdout, pstderr], kwargs
+
+    def start(self, input=None):
+        assert not self._popen, 'already inited'
+
+        (pstdin, pstdout, pstderr), kwargs = self._handles(input)
+        if USE_POSIX_SPAWN:
+            file_actions = _spawn_actions((pstdin, pstdout, pstderr), kwargs)
+            if file_actions is not None:
+                self._popen = _direct_spawn(self._cmdline, file_actions, kwargs)
 
-        self._popen = subprocess.Popen(self._cmdline,
-                                       stdin=pstdin, stdout=pstdout, stderr=pstderr,
-                                       **self._kwargs)
+        if not self._popen:
+            self._popen = subprocess.Popen(self._cmdline,
+                                           stdin=pstdin, stdout=pstdout, stderr=pstderr,
+                                           **kwargs)
         if self._stdin == INTERACT:
             self._input = self._popen.stdin
-        elif self._stdout == INTERACT:
+        if self._stdout == INTERACT:
             self._output = self._popen.stdout
         elif self._stderr == INTERACT:
             self._output = self._popen.stderr
@@ -191,23 +718,42 @@ class Process(Runnable):
                 self._pipe = self._popen.stderr
 
         if input is not None:
-            self._parallel(self._popen.stdin.write, input)
+            if _fits_pipe_buf(self._popen.stdin, input):
+                _write_input(self._popen.stdin, input)
+            else:
+                self._parallel(_write_input, self._popen.stdin, input)
+        if not self._capture_deferred:
+            self._capture(self._capture_targets())
+
+    def _capture_targets(self):
+        targets = []
         if self._stdout == CAPTURE:
-            def capture():
-                self._captured_stdout = self._popen.stdout.read()
-            self._parallel(capture)
+            targets.append((self, '_captured_stdout', self._popen.stdout))
         if self._stderr == CAPTURE:
-            def capture():
-                self._captured_stderr = self._popen.stderr.read()
-            self._parallel(capture)
+            targets.append((self, '_captured_stderr', self._popen.stderr))
+        for _, _, stream in targets:
+            _grow_pipe(stream.fileno())
+        return targets
+
+    def _capture(self, targets):
+        # all binary streams share one reader task, text streams get one each
+        binary = [target for target in targets if not isinstance(target[2], io.TextIOBase)]
+        single = [target for target in targets if isinstance(target[2], io.TextIOBase)]
+        if len(binary) > 1:
+            self._parallel(_capture_into, binary)
+        else:
+            single += binary
+        for target in single:
+            self._parallel(_capture_into, [target])
 
     def poll(self):
         return self._popen.poll()
 
-    def wait(self, timeout):
-        self._popen.wait(timeout)
-        for thread in self._threads:
-            thread.join()
+    def wait(self, timeout=None):
+        self._flush_pending()
+        _wait_popen(self._popen, timeout)
+        for future in self._futures:
+            future.result()
         return CompletedProcess(args=self._cmdline,
                                 returncode=self._popen.returncode,
                                 stdout=self._captured_stdout,
@@ -223,7 +769,8 @@ class Pipe(Runnable):
                  stdin=_UNDEFINED, stdout=_UNDEFINED, stderr=_UNDEFINED,
                  **kwargs):
         if not _preceding:
-            assert '|' in cmd, 'not a pipe'
+            if '|' not in cmd:
+                raise ValueError('not a pipe')
             preceding_cmd, cmd = cmd.rsplit('|', 1)
             spec_count = _spec_count(preceding_cmd)
             preceding_args = args[:spec_count]
@@ -238,8 +785,8 @@ class Pipe(Runnable):
                                        stderr=stderr,
                                        **kwargs)
             _preceding._prepare_pipe()
-        else:
-            assert stdin == _UNDEFINED
+        elif stdin != _UNDEFINED:
+            raise ValueError('stdin of a piped process comes from the preceding one')
             
         self._process = Process(cmd, *args,
                                 stdin=_UNDEFINED,
@@ -248,6 +795,7 @@ class Pipe(Runnable):
                                 **kwargs)
         self._preceding = _preceding
         self._parts = None
+        self._interactive = _preceding._interactive + self._process._interactive
         Runnable.__init__(self)
 
     @property
@@ -256,22 +804,170 @@ class Pipe(Runnable):
         return self._parts
 
     def _interactive_count(self):
-        return self._preceding._interactive_count() + self._process._interactive_count()
+        return self._interactive
 
     def _prepare_pipe(self):
         self._process._prepare_pipe()
 
+    def _chain(self):
+        if isinstance(self._preceding, Pipe):
+            return self._preceding._chain() + [self._process]
+        return [self._preceding, self._process]
+
+    def _start_chain(self):
+        # spawns all stages back to back over raw pipes, False if some stage needs Popen
+        if not USE_POSIX_SPAWN or not hasattr(os, 'pipe2'):
+            return False
+        parts = self._chain()
+        if any(part._stdin == INTERACT or
+               {part._stdout, part._stderr} & {CAPTURE, INTERACT} for part in parts):
+            return False
+        if PIPE in (parts[-1]._stdout, parts[-1]._stderr):
+            return False
+
+        fds = []
+        try:
+            plan = [part._handles(None) for part in parts]
+            for (handles, _), (next_handles, _), part in zip(plan, plan[1:], parts):
+                read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+                fds += [read_fd, write_fd]
+                handles[1 if part._stdout == PIPE else 2] = write_fd
+                next_handles[0] = read_fd
+            actions = [_spawn_actions(handles, kwargs) for handles, kwargs in plan]
+            if any(file_actions is None for file_actions in actions):
+                return False
+            for part, (_, kwargs), file_actions in zip(parts, plan, actions):
+                part._popen = _direct_spawn(part._cmdline, file_actions, kwargs)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self._parts = parts
+        return True
+
     def start(self, input=None):
-        self._preceding.start(input)
-        assert self._preceding._pipe
+        if input is None and self._start_chain():
+            return
+        # captures of every stage are drained by one reader task on the last stage
+        parts = self._chain()
+        for part in parts:
+            part._capture_deferred = True
+        self._start_parts(input)
+        self._process._capture([target for part in parts for target in part._capture_targets()])
+
+    def _start_parts(self, input):
+        if isinstance(self._preceding, Pipe):
+            self._preceding._start_parts(input)
+        else:
+            self._preceding.start(input)
+        if not self._preceding._pipe:
+            raise RuntimeError('preceding process is not piped')
         self._process._stdin = self._preceding._pipe
         self._process.start()
+        # the child holds its own copy, ours would keep the writer from seeing EPIPE
+        self._preceding._pipe.close()
         self._pipe = self._process._pipe
         self._input = self._preceding._input
         self._output = self._process._output
+        self._parts = self._preceding.parts + self._process.parts
 
     def poll(self):
         return self._process.poll()
 
     def wait(self, timeout=None):
-        return self._process.wait(timeout)
+        # every stage is reaped, the result is the last stage's
+        self._flush_pending()
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        result = self._process.wait(timeout)
+        for part in self.parts[:-1]:
+            if timeout is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            part.wait(timeout)
+        return result
+
+# Long-lived helper serving many run() calls: each request is written to the
+# child's stdin as a little-endian uint32 length followed by the body, and one
+# response framed the same way is read back from its stdout.
+class PooledProcess(Runnable):
+    def __init__(self, cmd, *args, stderr=_UNDEFINED, **kwargs):
+        self._process = Process(cmd, *args, stdin=INTERACT, stdout=INTERACT, stderr=stderr,
+                                _duplex=True, **kwargs)
+        self._interactive = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        Runnable.__init__(self)
+
+    def run(self, input=None, timeout=None):
+        if timeout is not None:
+            raise NotImplementedError('timeout is not supported for pooled processes')
+        if input is None:
+            input = b''
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('pooled process is shut down')
+            if not self._process._popen:
+                self._process.start()
+            try:
+                _writev_all(self._process.input.fileno(), [_FRAME_HEADER.pack(len(input)), input])
+            except BrokenPipeError:
+                body = None
+            else:
+                fd = self._process.output.fileno()
+                header = _read_exact(fd, _FRAME_HEADER.size)
+                body = header and _read_exact(fd, _FRAME_HEADER.unpack(header)[0])
+            if body is None:
+                self._closed = True
+                self._process.input.close()
+                self._process.output.close()
+                res = self._process.wait()
+                if res.returncode:
+                    raise CalledProcessError(res.returncode, res.args)
+                raise ProtocolError('%s exited before sending a complete response' % (res.args,))
+        return CompletedProcess(args=self._process._cmdline, returncode=0, stdout=body)
+
+    def start(self, input=None):
+        if input is not None:
+            raise ValueError('input is sent with run()')
+        with self._lock:
+            self._process.start()
+
+    def poll(self):
+        return self._process.poll()
+
+    def wait(self, timeout=None):
+        with self._lock:
+            if not self._process._popen:
+                raise RuntimeError('pooled process is not started')
+            if not self._closed:
+                # closing stdin asks the helper to exit
+                self._closed = True
+                self._process.input.close()
+        res = self._process.wait(timeout)
+        self._process.output.close()
+        return res
+
+    # requests and responses only go through run()
+    def iterate(self, input=None, timeout=None):
+        raise ValueError('pooled process is driven through run()')
+
+    def iterate_bytes(self, input=None, chunk=_ITER_CHUNK):
+        raise ValueError('pooled process is driven through run()')
+
+    def send(self, data):
+        raise ValueError('pooled process is driven through run()')
+
+    def flush(self):
+        raise ValueError('pooled process is driven through run()')
+
+    def close_input(self):
+        raise ValueError('pooled process is driven through run()')
+
+    @property
+    def parts(self):
+        return self._process.parts
+
+    def _interactive_count(self):
+        return self._interactive
+
+    def _prepare_pipe(self):
+        raise ValueError('pooled process can not be piped')
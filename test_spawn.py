@@ -0,0 +1,75 @@
+import sys
+import unittest
+
+import spawn
+
+# echoes every framed request back upper-cased, exits on EOF
+_HELPER = '''
+import struct, sys
+i, o = sys.stdin.buffer, sys.stdout.buffer
+while True:
+    header = i.read(4)
+    if len(header) < 4:
+        break
+    body = i.read(struct.unpack('<I', header)[0]).upper()
+    o.write(struct.pack('<I', len(body)) + body)
+    o.flush()
+'''
+
+class CmdlineTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(spawn.cmdline('ls -l'), ['ls', '-l'])
+        self.assertEqual(spawn.cmdline('echo %s %d', 'a', 3), ['echo', 'a', '3'])
+
+    def test_quoted(self):
+        self.assertEqual(spawn.cmdline('grep "a b" %s', 'f'), ['grep', 'a b', 'f'])
+        self.assertEqual(spawn.cmdline("sh -c 'echo %s'", 'x'), ['sh', '-c', 'echo x'])
+
+    def test_backslash_without_quotes(self):
+        self.assertEqual(spawn.cmdline('grep -E \\d+'), ['grep', '-E', '\\d+'])
+        self.assertEqual(spawn.cmdline('printf %s\\n', 'x'), ['printf', 'x\\n'])
+
+    def test_lone_apostrophe(self):
+        self.assertEqual(spawn.cmdline("echo it's"), ['echo', "it's"])
+
+    def test_percent_escape(self):
+        self.assertEqual(spawn.cmdline('echo 100%% %d%%', 5), ['echo', '100%', '5%'])
+        self.assertEqual(spawn.cmdline('echo x%%%s', 'y'), ['echo', 'x%y'])
+
+class PooledProcessTest(unittest.TestCase):
+    def test_round_trips(self):
+        helper = spawn.PooledProcess('%s -c %s', sys.executable, _HELPER)
+        self.assertEqual(helper.run(b'hello').stdout, b'HELLO')
+        self.assertEqual(helper.run(b'').stdout, b'')
+        self.assertEqual(helper.run(b'x' * 300000).stdout, b'X' * 300000)
+        self.assertEqual(helper.wait().returncode, 0)
+
+    def test_helper_without_response(self):
+        helper = spawn.PooledProcess('%s -c %s', sys.executable, 'import sys; sys.stdin.buffer.read(4)')
+        with self.assertRaises(spawn.ProtocolError):
+            helper.run(b'hello')
+
+    def test_failing_helper(self):
+        helper = spawn.PooledProcess('%s -c %s', sys.executable, 'import sys; sys.exit(3)')
+        with self.assertRaises(spawn.CalledProcessError) as ctx:
+            helper.run(b'hello')
+        self.assertEqual(ctx.exception.returncode, 3)
+
+    def test_lifecycle_errors(self):
+        helper = spawn.PooledProcess('%s -c %s', sys.executable, _HELPER)
+        with self.assertRaises(RuntimeError):
+            helper.wait()
+        helper.run(b'a')
+        helper.wait()
+        with self.assertRaises(RuntimeError):
+            helper.run(b'a')
+        with self.assertRaises(ValueError):
+            helper.send(b'a')
+
+    def test_timeout_rejected(self):
+        helper = spawn.PooledProcess('%s -c %s', sys.executable, _HELPER)
+        with self.assertRaises(NotImplementedError):
+            helper.run(b'a', timeout=1)
+
+if __name__ == '__main__':
+    unittest.main()